@@ -0,0 +1,347 @@
+import json
+import os
+import datetime
+import ctypes
+import ctypes.util
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; writers are then unsynchronised
+    fcntl = None
+
+# Sequence-numbered change feed. Every write to the todo or ideas file also
+# appends one JSON line to the journal describing what changed, so other
+# processes (the REPL, the Discord bot) can apply the same deltas to their
+# in-memory copies instead of re-reading the whole document.
+#
+# Each entry is {"seq": n, "time": iso, "source": "repl"|"bot", "ops": [...],
+# "undo": [...]} where "undo" holds the inverse ops that take the documents
+# back to how they were before the entry. Undo and redo are themselves
+# entries, marked with "undo_of" or "redo_of" and the seq they reverse.
+#
+# Each op is one of ("index"/"to_index" on add, add_idea and move are
+# optional and default to appending):
+#   {"op": "add", "subcategory": s, "task": {...}, "index": i}
+#   {"op": "remove", "subcategory": s, "index": i, "created": iso}
+#   {"op": "update", "subcategory": s, "index": i, "fields": {...}, "unset": [keys], "created": iso}
+#   {"op": "move", "from": s, "index": i, "to": t, "to_index": j, "created": iso}
+#   {"op": "create_subcategory" | "delete_subcategory", "subcategory": s}
+#   {"op": "bench_category" | "unbench_category", "subcategory": s}
+#   {"op": "add_idea", "idea": {...}, "index": i}
+#   {"op": "remove_idea", "index": i, "created": iso}
+#
+# "created" is optional on remove, update and move; when present the op
+# refuses to touch a task with a different one. Inverse ops always carry it.
+
+CHANGES_FILE = 'todo_changes.jsonl'
+
+# inotify event masks (see <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+TODO_OPS = ("add", "remove", "update", "move", "create_subcategory", "delete_subcategory", "bench_category", "unbench_category")
+IDEA_OPS = ("add_idea", "remove_idea")
+
+def _insert(items, index, item):
+    position = len(items) if index is None else index
+    items.insert(position, item)
+    return position
+
+def _task_at(subcategories, name, op, index, action):
+    task = subcategories[name][index]
+    if "created" in op and task.get("created") != op["created"]:
+        raise ValueError(f"Task {index} in '{name}' is not the one being {action}.")
+    return task
+
+def _apply_op(todos, ideas, op):
+    # Applies one op and returns the op that reverses it
+    kind = op["op"]
+    if kind in TODO_OPS:
+        subcategories = todos["subcategories"]
+    if kind == "add":
+        task = dict(op["task"])
+        position = _insert(subcategories[op["subcategory"]], op.get("index"), task)
+        return {"op": "remove", "subcategory": op["subcategory"], "index": position, "created": task.get("created")}
+    if kind == "remove":
+        tasks = subcategories[op["subcategory"]]
+        _task_at(subcategories, op["subcategory"], op, op["index"], "removed")
+        task = tasks.pop(op["index"])
+        return {"op": "add", "subcategory": op["subcategory"], "task": task, "index": op["index"]}
+    if kind == "update":
+        task = _task_at(subcategories, op["subcategory"], op, op["index"], "updated")
+        changed = list(op["fields"]) + op.get("unset", [])
+        inverse = {"op": "update", "subcategory": op["subcategory"], "index": op["index"],
+                   "fields": {key: task[key] for key in changed if key in task},
+                   "unset": [key for key in changed if key not in task]}
+        task.update(op["fields"])
+        for key in op.get("unset", []):
+            task.pop(key, None)
+        inverse["created"] = task.get("created")
+        return inverse
+    if kind == "move":
+        _task_at(subcategories, op["from"], op, op["index"], "moved")
+        task = subcategories[op["from"]].pop(op["index"])
+        position = _insert(subcategories[op["to"]], op.get("to_index"), task)
+        return {"op": "move", "from": op["to"], "index": position, "to": op["from"], "to_index": op["index"],
+                "created": task.get("created")}
+    if kind == "create_subcategory":
+        if op["subcategory"] in subcategories:
+            raise ValueError(f"Subcategory '{op['subcategory']}' already exists.")
+        subcategories[op["subcategory"]] = []
+        return {"op": "delete_subcategory", "subcategory": op["subcategory"]}
+    if kind == "delete_subcategory":
+        if subcategories[op["subcategory"]]:
+            raise ValueError(f"Subcategory '{op['subcategory']}' is not empty.")
+        del subcategories[op["subcategory"]]
+        return {"op": "create_subcategory", "subcategory": op["subcategory"]}
+    if kind == "bench_category":
+        todos.setdefault("benched_categories", []).append(op["subcategory"])
+        return {"op": "unbench_category", "subcategory": op["subcategory"]}
+    if kind == "unbench_category":
+        todos["benched_categories"].remove(op["subcategory"])
+        return {"op": "bench_category", "subcategory": op["subcategory"]}
+    if kind == "add_idea":
+        idea = dict(op["idea"])
+        position = _insert(ideas, op.get("index"), idea)
+        return {"op": "remove_idea", "index": position, "created": idea.get("created")}
+    if kind == "remove_idea":
+        if "created" in op and ideas[op["index"]].get("created") != op["created"]:
+            raise ValueError(f"Idea {op['index']} is not the one being removed.")
+        return {"op": "add_idea", "idea": ideas.pop(op["index"]), "index": op["index"]}
+    raise ValueError(f"Unknown change operation '{kind}'.")
+
+def apply_ops(todos, ideas, ops):
+    # Either document may be None when the caller does not hold a copy of it.
+    # Returns the ops that undo the ones applied, in the order to apply them.
+    undo = []
+    for op in ops:
+        kind = op["op"]
+        if (kind in TODO_OPS and todos is None) or (kind in IDEA_OPS and ideas is None):
+            continue
+        undo.append(_apply_op(todos, ideas, op))
+    undo.reverse()
+    return undo
+
+@contextmanager
+def locked_journal(path=CHANGES_FILE):
+    # Held by writers across "save the data files + append the entry", and by
+    # readers across "load the data files + note the journal position", so a
+    # reader never sees a saved change without its entry or vice versa
+    with open(path, 'a+') as journal:
+        if fcntl:
+            fcntl.flock(journal, fcntl.LOCK_EX)
+        try:
+            yield journal
+        finally:
+            if fcntl:
+                fcntl.flock(journal, fcntl.LOCK_UN)
+
+@contextmanager
+def shared_journal(path=CHANGES_FILE):
+    # Readers lock a read-only handle: closing one opened for writing fires
+    # inotify events (and so wakes every follower) even if nothing was written.
+    # Yields None when there is no journal yet.
+    try:
+        journal = open(path, 'r')
+    except FileNotFoundError:
+        yield None
+        return
+    with journal:
+        if fcntl:
+            fcntl.flock(journal, fcntl.LOCK_SH)
+        try:
+            yield journal
+        finally:
+            if fcntl:
+                fcntl.flock(journal, fcntl.LOCK_UN)
+
+def _last_line_start(journal, end, block=4096):
+    # Offset just past the last newline before `end` (0 if there is none)
+    start = end
+    while start > 0:
+        start = max(0, start - block)
+        journal.seek(start)
+        newline = journal.read(end - start).rfind('\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+def drop_torn_entry(journal):
+    # A writer that crashed mid-append leaves an unterminated last line. Its
+    # change was never committed (see recover_pending), so it is cut off.
+    # Must be called with the journal lock held.
+    end = journal.seek(0, os.SEEK_END)
+    complete = _last_line_start(journal, end)
+    if complete < end:
+        journal.truncate(complete)
+
+def last_seq(journal):
+    # The seq of the last complete entry; an unterminated final line is ignored
+    end = _last_line_start(journal, journal.seek(0, os.SEEK_END))
+    if end == 0:
+        return 0
+    start = _last_line_start(journal, end - 1)
+    journal.seek(start)
+    return json.loads(journal.read(end - start))["seq"]
+
+def append_change(journal, ops, source, undo, **marks):
+    entry = {
+        "seq": last_seq(journal) + 1,
+        "time": datetime.datetime.now().isoformat(),
+        "source": source,
+        "ops": ops,
+        "undo": undo,
+    }
+    entry.update(marks)
+    journal.seek(0, os.SEEK_END)
+    journal.write(json.dumps(entry) + '\n')
+    journal.flush()
+    # The entry is the commit point, so it must be on disk before the caller
+    # renames the staged files into place
+    os.fsync(journal.fileno())
+    return entry
+
+def cursor_at_end(journal, path=CHANGES_FILE):
+    return {"path": path, "offset": journal.seek(0, os.SEEK_END), "seq": last_seq(journal)}
+
+def read_changes(cursor):
+    # Returns the entries appended since the cursor and advances it, or None
+    # when the journal was truncated or has a gap and the caller must reload
+    path = cursor["path"]
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size < cursor["offset"]:
+        return None
+    if size == cursor["offset"]:
+        return []
+    entries = []
+    with open(path, 'rb') as journal:
+        journal.seek(cursor["offset"])
+        for line in journal:
+            if not line.endswith(b'\n'):
+                break  # Entry still being written, or torn by a crash; not committed
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                return None
+            if entry["seq"] != cursor["seq"] + 1:
+                return None
+            entries.append(entry)
+            cursor["seq"] = entry["seq"]
+            cursor["offset"] += len(line)
+    return entries
+
+def iter_changes_reversed(path=CHANGES_FILE, block=64 * 1024):
+    # Yields journal entries newest first, reading the file backwards in
+    # blocks so only the entries actually visited are held in memory
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as journal:
+        position = journal.seek(0, os.SEEK_END)
+        remainder = b''
+        # Whatever follows the last newline is an entry that was never committed
+        torn = True
+        while position > 0:
+            start = max(0, position - block)
+            journal.seek(start)
+            lines = (journal.read(position - start) + remainder).split(b'\n')
+            position = start
+            # The first piece may be the tail of a line that starts further back
+            remainder = lines.pop(0) if position > 0 else b''
+            if torn and lines:
+                lines.pop()
+                torn = False
+            for line in reversed(lines):
+                if line.strip():
+                    yield json.loads(line)
+
+def first_change_time(path=CHANGES_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as journal:
+        line = journal.readline()
+    return json.loads(line)["time"] if line.endswith('\n') and line.strip() else None
+
+def find_undo_target(path=CHANGES_FILE):
+    # The newest entry that has not been undone yet. Undo entries are not
+    # themselves undoable (that is what redo is for); redo entries are.
+    undone = set()
+    for entry in iter_changes_reversed(path):
+        if "undo_of" in entry:
+            undone.add(entry["undo_of"])
+        elif entry["seq"] not in undone:
+            return entry
+    return None
+
+def find_redo_target(path=CHANGES_FILE):
+    # The newest undo entry not yet redone, provided nothing new has been
+    # changed since; a fresh change discards whatever could be redone
+    redone = set()
+    for entry in iter_changes_reversed(path):
+        if "redo_of" in entry:
+            redone.add(entry["redo_of"])
+        elif "undo_of" in entry:
+            if entry["seq"] not in redone:
+                return entry
+        else:
+            return None
+    return None
+
+def rewind(todos, ideas, until, path=CHANGES_FILE):
+    # Returns views of both documents as they were at the ISO time `until`, by
+    # applying the undo ops of every later entry. Only the lists and tasks those
+    # ops touch are copied; everything else is shared with the current copies.
+    view = dict(todos, subcategories=dict(todos["subcategories"]))
+    view["benched_categories"] = list(todos.get("benched_categories", []))
+    ideas_view = list(ideas) if ideas is not None else None
+    copied = set()
+    for entry in iter_changes_reversed(path):
+        if entry["time"] <= until:
+            break
+        if "undo" not in entry:
+            raise ValueError(f"Change {entry['seq']} was recorded without undo information.")
+        for op in entry["undo"]:
+            for key in ("subcategory", "from", "to"):
+                name = op.get(key)
+                if name in view["subcategories"] and name not in copied:
+                    view["subcategories"][name] = list(view["subcategories"][name])
+                    copied.add(name)
+            try:
+                if op["op"] == "update":
+                    tasks = view["subcategories"][op["subcategory"]]
+                    tasks[op["index"]] = dict(tasks[op["index"]])
+                apply_ops(view, ideas_view, [op])
+            except (IndexError, KeyError, ValueError) as e:
+                raise ValueError(f"Cannot rewind past change {entry['seq']}: the data no longer matches ({e}).")
+    return view, ideas_view
+
+def open_watch(path=CHANGES_FILE):
+    # Returns a non-blocking inotify descriptor that becomes readable when the
+    # journal's directory changes, or None where inotify is unavailable
+    library = ctypes.util.find_library('c')
+    if not library:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    directory = os.path.dirname(os.path.abspath(path))
+    # Not IN_CLOSE_WRITE: writers' lock handles are opened for appending, so
+    # closing one fires it even when nothing was written
+    mask = IN_MODIFY | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def drain_watch(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
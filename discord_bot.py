@@ -4,7 +4,13 @@ import json
 import datetime
 import os
 import logging
-from idl import load_todos, save_todos, add_todo, mark_todo_complete
+import heapq
+import asyncio
+from idl import TODO_FILE, add_todo, mark_todo_complete, edit_todos, stop_fields, new_state, sync_state, state_version, find_duplicates
+from task_stream import iter_tasks
+from task_query import cached_index, parse_query, run_query, format_task
+from user_index import ACTIVITY_KINDS, build_user_index, index_op, task_key, has_verified, activity_since, activity_counts, leaderboard
+from changes import open_watch, drain_watch
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -20,6 +26,12 @@ SUBCATEGORY = 'ipe'
 # Specify the channel name where the bot should work
 CHANNEL_NAME = 'engine'
 
+# Post a notice to the channel when a task is completed outside the bot (e.g. from idl.py)
+POST_COMPLETION_NOTICES = True
+
+# How often to check the change feed when file notifications are unavailable, in seconds
+CHANGE_POLL_INTERVAL = 5
+
 # Function to check if the command is used in the correct channel
 def check_channel(ctx):
     return ctx.channel.name == CHANNEL_NAME
@@ -32,19 +44,94 @@ def read_bot_token():
     with open(token_file, 'r') as file:
         return file.read().strip()
 
+# In-memory copy of the data and the per-user activity index, both kept
+# current by applying change-feed deltas rather than re-reading the files
+feed_state = new_state()
+user_activity = {"index": None, "watcher": None}
+
+async def sync_feed():
+    notices = []
+
+    def on_op(entry, op):
+        # Undo can take activity away, which the index only learns by rebuilding
+        if "undo_of" in entry or not index_op(user_activity["index"], feed_state["todos"], op):
+            user_activity["index"] = build_user_index(feed_state["todos"])
+        if (op["op"] == "update" and op["fields"].get('completed') and op["subcategory"] == SUBCATEGORY
+                and entry["source"] != 'bot'):
+            task = feed_state["todos"]["subcategories"][SUBCATEGORY][op["index"]]
+            notices.append(f"Task completed: {task['task']}")
+
+    entries = sync_state(feed_state, on_op)
+    if entries is None or user_activity["index"] is None:
+        user_activity["index"] = build_user_index(feed_state["todos"])
+
+    if POST_COMPLETION_NOTICES and notices:
+        for guild in bot.guilds:
+            channel = discord.utils.get(guild.text_channels, name=CHANNEL_NAME)
+            if channel:
+                for notice in notices:
+                    await channel.send(notice)
+    return feed_state["todos"]
+
+async def get_user_index():
+    await sync_feed()
+    return user_activity["index"]
+
+async def follow_changes():
+    # Wakes on inotify events for the journal's directory where available,
+    # otherwise checks the feed every CHANGE_POLL_INTERVAL seconds
+    changed = asyncio.Event()
+    fd = open_watch()
+    if fd is not None:
+        def on_watch_event():
+            drain_watch(fd)
+            changed.set()
+        asyncio.get_running_loop().add_reader(fd, on_watch_event)
+    while True:
+        if fd is not None:
+            await changed.wait()
+            changed.clear()
+        else:
+            await asyncio.sleep(CHANGE_POLL_INTERVAL)
+        try:
+            await sync_feed()
+        except Exception as e:
+            logging.error(f"Failed to apply changes: {e}")
+
+# Function to turn 'month', 'week', 'today' or a date like 2024-10 into an ISO lower bound
+def parse_since(period):
+    if period is None:
+        return None
+    today = datetime.date.today()
+    if period == 'today':
+        return today.isoformat()
+    if period == 'week':
+        return (today - datetime.timedelta(days=today.weekday())).isoformat()
+    if period == 'month':
+        return today.replace(day=1).isoformat()
+    if period == 'year':
+        return today.replace(month=1, day=1).isoformat()
+    # Accept 2024, 2024-10 or 2024-10-05
+    since = (period + '-01-01')[:10] if len(period) < 10 else period
+    datetime.date.fromisoformat(since)
+    return since
+
 @bot.event
 async def on_ready():
     logging.info(f'{bot.user} has connected to Discord!')
     # Ensure the Discord subcategory exists
-    todos = load_todos()
-    if SUBCATEGORY not in todos["subcategories"]:
-        todos["subcategories"][SUBCATEGORY] = []
-        save_todos(todos)
+    with edit_todos('bot') as (todos, ops):
+        if SUBCATEGORY not in todos["subcategories"]:
+            ops.append({"op": "create_subcategory", "subcategory": SUBCATEGORY})
+    await sync_feed()
+    # on_ready can fire again after a reconnect; only start following once
+    if user_activity["watcher"] is None:
+        user_activity["watcher"] = asyncio.create_task(follow_changes())
 
 @bot.command(name='todos')
 @commands.check(check_channel)
 async def list_todos(ctx):
-    todos = load_todos()
+    todos = await sync_feed()
     todo_list = todos["subcategories"][SUBCATEGORY]
     
     # Filter active tasks (not completed and not benched)
@@ -90,21 +177,17 @@ async def list_todos(ctx):
 @bot.command(name='completed')
 @commands.check(check_channel)
 async def list_completed(ctx, num_tasks: int = 10):
-    todos = load_todos()
-    todo_list = todos["subcategories"][SUBCATEGORY]
-    
-    # Get completed tasks
-    completed_tasks = [todo for todo in todo_list if todo.get('completed')]
-    
-    if not completed_tasks:
-        await ctx.send("There are no completed tasks.")
+    if num_tasks <= 0:
+        await ctx.send("The number of tasks must be a positive number.")
         return
 
-    # Sort tasks by the 'completed' field in descending order (most recent first)
-    completed_tasks.sort(key=lambda x: x.get('completed', ''), reverse=True)
+    # Stream completed tasks and keep only the most recent ones (most recent first)
+    completed_tasks = (todo for _, todo in iter_tasks(TODO_FILE, SUBCATEGORY) if todo.get('completed'))
+    limited_completed_tasks = heapq.nlargest(num_tasks, completed_tasks, key=lambda x: x.get('completed', ''))
     
-    # Limit the tasks to the specified number (or default to 10 if not specified)
-    limited_completed_tasks = completed_tasks[:num_tasks]
+    if not limited_completed_tasks:
+        await ctx.send("There are no completed tasks.")
+        return
     
     # Function to create a formatted string for a completed task
     def format_task(idx, todo):
@@ -136,7 +219,7 @@ async def list_completed(ctx, num_tasks: int = 10):
 @bot.command(name='benched')
 @commands.check(check_channel)
 async def list_benched(ctx):
-    todos = load_todos()
+    todos = await sync_feed()
     todo_list = todos["subcategories"][SUBCATEGORY]
     
     benched_tasks = [todo for todo in todo_list if todo.get('benched')]
@@ -170,81 +253,123 @@ async def list_benched(ctx):
     for idx, response in enumerate(responses):
         await ctx.send(f"Page {idx+1}/{len(responses)}:\n{response}")
 
+@bot.command(name='find')
+@commands.check(check_channel)
+async def find_todos(ctx, *, query_text=''):
+    try:
+        query = parse_query(query_text)
+    except ValueError as e:
+        await ctx.send(f"Invalid query: {e}")
+        return
+    
+    todos = await sync_feed()
+    todo_list = todos["subcategories"][SUBCATEGORY]
+    index = cached_index(TODO_FILE, SUBCATEGORY, todo_list, state_version(feed_state))
+    total, window = run_query(index, query)
+    
+    if not window:
+        await ctx.send(f"No tasks match that query ({total} matches in total).")
+        return
+
+    # Create paginated responses for the requested window only
+    responses = []
+    current_response = "Matching Tasks:\n"
+    
+    for idx, task_idx in enumerate(window):
+        task_str = f"{query['offset'] + idx + 1}. {format_task(todo_list[task_idx])}\n"
+        if len(current_response) + len(task_str) > 1900:
+            responses.append(current_response)
+            current_response = task_str
+        else:
+            current_response += task_str
+    
+    if current_response:
+        responses.append(current_response)
+
+    # Send paginated responses
+    for idx, response in enumerate(responses):
+        await ctx.send(f"Page {idx+1}/{len(responses)}:\n{response}")
+
+    await ctx.send(f"Showing {query['offset'] + 1}-{query['offset'] + len(window)} of {total} matching tasks. Use offset:N and limit:N to see more.")
+
 @bot.command(name='add')
 @commands.check(check_channel)
 async def add_todo_item(ctx, *, task):
-    add_todo(task, SUBCATEGORY)
+    await sync_feed()
+    duplicates = find_duplicates(feed_state, task)
+    add_todo(task, SUBCATEGORY, {
+        'added_by_id': str(ctx.author.id),
+        'added_by_name': ctx.author.name
+    }, source='bot')
     await ctx.send(f"Added a new task to the todo list: {task}")
+    if duplicates:
+        lines = [f"- {existing} (In: {where}, {score:.0%} similar)" for score, existing, where in duplicates]
+        await ctx.send("This looks similar to existing items:\n" + "\n".join(lines))
 
 @bot.command(name='complete')
 @commands.check(check_channel)
 async def complete_todo(ctx, index: int):
-    todos = load_todos()
-    todo_list = todos["subcategories"][SUBCATEGORY]
-    
-    active_tasks = [todo for todo in todo_list if not todo.get('completed') and not todo.get('benched')]
-    
-    if 0 < index <= len(active_tasks):
-        todo = active_tasks[index - 1]
-        if not todo.get('completed'):
-            todo['completed'] = datetime.datetime.now().isoformat()
-            todo['completed_by_id'] = str(ctx.author.id)
-            todo['completed_by_name'] = ctx.author.name
-            save_todos(todos)
-            await ctx.send(f"Marked item {index} as complete.")
+    # Work out the reply while holding the data, and send it once the write is done
+    with edit_todos('bot') as (todos, ops):
+        todo_list = todos["subcategories"][SUBCATEGORY]
+        
+        active_tasks = [(idx, todo) for idx, todo in enumerate(todo_list) if not todo.get('completed') and not todo.get('benched')]
+        
+        if 0 < index <= len(active_tasks):
+            todo_index, todo = active_tasks[index - 1]
+            if not todo.get('completed'):
+                ops.append({"op": "update", "subcategory": SUBCATEGORY, "index": todo_index, "fields": {
+                    'completed': datetime.datetime.now().isoformat(),
+                    'completed_by_id': str(ctx.author.id),
+                    'completed_by_name': ctx.author.name
+                }})
+                reply = f"Marked item {index} as complete."
+            else:
+                reply = f"Item {index} is already completed."
         else:
-            await ctx.send(f"Item {index} is already completed.")
-    else:
-        await ctx.send("Invalid index.")
+            reply = "Invalid index."
+    await ctx.send(reply)
 
 @bot.command(name='verify')
 @commands.check(check_channel)
 async def verify_completed_task(ctx, index: int):
-    todos = load_todos()
-    todo_list = todos["subcategories"][SUBCATEGORY]
+    user_index = await get_user_index()
     
-    # Filter completed tasks
-    completed_tasks = [todo for todo in todo_list if todo.get('completed')]
-    
-    if 0 < index <= len(completed_tasks):
-        task = completed_tasks[index - 1]
-        
-        # Initialize verifications field if not present
-        if 'verifications' not in task:
-            task['verifications'] = []
-            task['verification_count'] = 0
+    with edit_todos('bot') as (todos, ops):
+        todo_list = todos["subcategories"][SUBCATEGORY]
         
-        # Check if the user has already verified the task
-        verifier_id = str(ctx.author.id)
-        if verifier_id in [v['id'] for v in task['verifications']]:
-            await ctx.send(f"{ctx.author.name}, you have already verified this task.")
-            return
+        # Filter completed tasks
+        completed_tasks = [(idx, todo) for idx, todo in enumerate(todo_list) if todo.get('completed')]
         
-        # Add the verification
-        task['verifications'].append({
-            'id': verifier_id,
-            'name': ctx.author.name,
-            'verified_at': datetime.datetime.now().isoformat()
-        })
-        task['verification_count'] += 1
-        save_todos(todos)
-        
-        await ctx.send(f"{ctx.author.name} has verified task {index}. Total verifications: {task['verification_count']}")
-    else:
-        await ctx.send("Invalid task index. Please provide a valid number from the list of completed tasks.")
+        if 0 < index <= len(completed_tasks):
+            todo_index, task = completed_tasks[index - 1]
+            
+            # Check if the user has already verified the task
+            verifier_id = str(ctx.author.id)
+            if has_verified(user_index, verifier_id, task_key(SUBCATEGORY, task)):
+                reply = f"{ctx.author.name}, you have already verified this task."
+            else:
+                # Add the verification
+                verifications = task.get('verifications', []) + [{
+                    'id': verifier_id,
+                    'name': ctx.author.name,
+                    'verified_at': datetime.datetime.now().isoformat()
+                }]
+                verification_count = task.get('verification_count', 0) + 1
+                ops.append({"op": "update", "subcategory": SUBCATEGORY, "index": todo_index, "fields": {
+                    'verifications': verifications,
+                    'verification_count': verification_count
+                }})
+                reply = f"{ctx.author.name} has verified task {index}. Total verifications: {verification_count}"
+        else:
+            reply = "Invalid task index. Please provide a valid number from the list of completed tasks."
+    await ctx.send(reply)
 
 @bot.command(name='verified')
 @commands.check(check_channel)
 async def list_verified_tasks(ctx):
-    todos = load_todos()
-    todo_list = todos["subcategories"][SUBCATEGORY]
-    
-    # Filter completed tasks that have been verified
-    verified_tasks = [todo for todo in todo_list if todo.get('completed') and todo.get('verification_count', 0) > 0]
-    
-    if not verified_tasks:
-        await ctx.send("There are no verified tasks.")
-        return
+    # Stream completed tasks that have been verified
+    verified_tasks = (todo for _, todo in iter_tasks(TODO_FILE, SUBCATEGORY) if todo.get('completed') and todo.get('verification_count', 0) > 0)
 
     # Function to format the task with verification info
     def format_task(idx, todo):
@@ -254,8 +379,10 @@ async def list_verified_tasks(ctx):
     # Create paginated responses
     responses = []
     current_response = "Verified Completed Tasks:\n"
+    num_verified = 0
     
     for idx, todo in enumerate(verified_tasks):
+        num_verified += 1
         task_str = format_task(idx, todo) + "\n"
         if len(current_response) + len(task_str) > 1900:
             responses.append(current_response)
@@ -263,6 +390,10 @@ async def list_verified_tasks(ctx):
         else:
             current_response += task_str
     
+    if not num_verified:
+        await ctx.send("There are no verified tasks.")
+        return
+    
     if current_response:
         responses.append(current_response)
 
@@ -273,49 +404,99 @@ async def list_verified_tasks(ctx):
 @bot.command(name='start')
 @commands.check(check_channel)
 async def start_todo(ctx, index: int):
-    todos = load_todos()
-    todo_list = todos["subcategories"][SUBCATEGORY]
-    
-    active_tasks = [todo for todo in todo_list if not todo.get('completed') and not todo.get('benched')]
-    
-    if 0 < index <= len(active_tasks):
-        todo = active_tasks[index - 1]
-        if not todo.get('completed') and not todo.get('in_progress'):
-            todo['in_progress'] = True
-            todo['start_time'] = datetime.datetime.now().isoformat()
-            todo['started_by_id'] = str(ctx.author.id)
-            todo['started_by_name'] = ctx.author.name
-            save_todos(todos)
-            await ctx.send(f"Started item {index}.")
-        elif todo.get('completed'):
-            await ctx.send(f"Item {index} is already completed.")
+    with edit_todos('bot') as (todos, ops):
+        todo_list = todos["subcategories"][SUBCATEGORY]
+        
+        active_tasks = [(idx, todo) for idx, todo in enumerate(todo_list) if not todo.get('completed') and not todo.get('benched')]
+        
+        if 0 < index <= len(active_tasks):
+            todo_index, todo = active_tasks[index - 1]
+            if not todo.get('completed') and not todo.get('in_progress'):
+                start_time = datetime.datetime.now().isoformat()
+                ops.append({"op": "update", "subcategory": SUBCATEGORY, "index": todo_index, "fields": {
+                    'in_progress': True,
+                    'start_time': start_time,
+                    'started_at': start_time,
+                    'started_by_id': str(ctx.author.id),
+                    'started_by_name': ctx.author.name
+                }})
+                reply = f"Started item {index}."
+            elif todo.get('completed'):
+                reply = f"Item {index} is already completed."
+            else:
+                reply = f"Item {index} is already in progress."
         else:
-            await ctx.send(f"Item {index} is already in progress.")
-    else:
-        await ctx.send("Invalid index.")
+            reply = "Invalid index."
+    await ctx.send(reply)
 
 @bot.command(name='stop')
 @commands.check(check_channel)
 async def stop_todo(ctx):
-    todos = load_todos()
-    todo_list = todos["subcategories"][SUBCATEGORY]
-    stopped = False
+    reply = "No task is currently in progress."
+    with edit_todos('bot') as (todos, ops):
+        todo_list = todos["subcategories"][SUBCATEGORY]
+        
+        for todo_index, task in enumerate(todo_list):
+            if task.get('in_progress'):
+                fields = stop_fields(task)
+                fields['stopped_by_id'] = str(ctx.author.id)
+                fields['stopped_by_name'] = ctx.author.name
+                ops.append({"op": "update", "subcategory": SUBCATEGORY, "index": todo_index, "fields": fields})
+                reply = "Stopped the in-progress task."
+                break
+    await ctx.send(reply)
+
+async def send_user_activity(ctx, user_id, name, period):
+    try:
+        since = parse_since(period)
+    except ValueError:
+        await ctx.send("Invalid period. Use today, week, month, year or a date like 2024-10.")
+        return
+    
+    index = await get_user_index()
+    counts = activity_counts(index, user_id, since)
+    heading = f"Activity for {name}" + (f" since {since}" if since else "") + ":"
+    summary = ", ".join(f"{kind.capitalize()}: {counts[kind]}" for kind in ACTIVITY_KINDS)
     
-    for task in todo_list:
-        if task.get('in_progress'):
-            task['in_progress'] = False
-            time_spent = (datetime.datetime.now() - datetime.datetime.fromisoformat(task['start_time'])).total_seconds()
-            task['time_spent'] = task.get('time_spent', 0) + time_spent
-            task['start_time'] = None
-            task['stopped_by_id'] = str(ctx.author.id)
-            task['stopped_by_name'] = ctx.author.name
-            save_todos(todos)
-            await ctx.send(f"Stopped the in-progress task.")
-            stopped = True
-            break
+    # Most recent completions first
+    recent = activity_since(index, user_id, "completed", since, limit=10)[::-1]
+    lines = [heading, summary]
+    if recent:
+        lines.append("Recently completed:")
+        for idx, (completed, key) in enumerate(recent):
+            lines.append(f"{idx + 1}. {index['titles'].get(key, 'Unknown task')} (Completed: {completed})")
+    await ctx.send("\n".join(lines)[:1900])
+
+@bot.command(name='mine')
+@commands.check(check_channel)
+async def show_my_activity(ctx, period: str = None):
+    await send_user_activity(ctx, ctx.author.id, ctx.author.name, period)
+
+@bot.command(name='user')
+@commands.check(check_channel)
+async def show_user_activity(ctx, member: discord.Member, period: str = None):
+    await send_user_activity(ctx, member.id, member.name, period)
+
+@bot.command(name='leaderboard')
+@commands.check(check_channel)
+async def show_leaderboard(ctx, kind: str = 'completed', period: str = None):
+    if kind not in ACTIVITY_KINDS:
+        await ctx.send(f"Unknown leaderboard. Choose one of: {', '.join(ACTIVITY_KINDS)}.")
+        return
+    try:
+        since = parse_since(period)
+    except ValueError:
+        await ctx.send("Invalid period. Use today, week, month, year or a date like 2024-10.")
+        return
+    
+    top = leaderboard(await get_user_index(), kind, since)
+    if not top:
+        await ctx.send(f"Nobody has {kind} any tasks yet.")
+        return
     
-    if not stopped:
-        await ctx.send("No task is currently in progress.")
+    heading = f"Top contributors by tasks {kind}" + (f" since {since}" if since else "") + ":"
+    lines = [heading] + [f"{idx + 1}. {name} ({count})" for idx, (name, count) in enumerate(top)]
+    await ctx.send("\n".join(lines))
 
 @bot.command(name='todohelp')
 @commands.check(check_channel)
@@ -325,10 +506,14 @@ async def show_todo_help(ctx):
     !todos - List all active todos
     !completed - List completed todos
     !benched - List benched todos
+    !find <query> - Search todos, e.g. !find status:completed completed>=2024-09-01 sort:-completed limit:10
     !add <task> - Add a new todo
     !complete <index> - Mark a todo as complete
     !start <index> - Start working on a todo
     !stop - Stop working on the current todo
+    !mine [period] - Show your activity (period: today, week, month, year or a date like 2024-10)
+    !user @someone [period] - Show someone else's activity
+    !leaderboard [added|started|completed|verified] [period] - Show top contributors
     !todohelp - Show this help message
     """
     await ctx.send(help_text)
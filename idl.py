@@ -1,39 +1,39 @@
 import json
 import datetime
 import os
+import glob
 import matplotlib.pyplot as plt
 from collections import defaultdict
+from contextlib import contextmanager
+from changes import apply_ops, locked_journal, shared_journal, drop_torn_entry, append_change, cursor_at_end, read_changes, last_seq, find_undo_target, find_redo_target, rewind, first_change_time, TODO_OPS, IDEA_OPS
+from task_query import cached_index, parse_query, run_query, format_task
+from similarity import build_similarity_index, find_similar, find_pairs, index_change, todo_key, idea_key
 
 # Path to the JSON file
 TODO_FILE = 'todo_list.json'
 IDEAS_FILE = 'ideas_list.json'
 
-def migrate_todo_data():
-    if os.path.exists(TODO_FILE):
-        with open(TODO_FILE, 'r') as file:
-            data = json.load(file)
-        if isinstance(data, list):
-            # Old format detected, migrate to new format
-            new_data = {
-                "subcategories": {"default": data},
-                "benched_categories": []
-            }
-            save_todos(new_data)
-            print("Migrated old to-do list format to new subcategory format.")
-        elif isinstance(data, dict) and "subcategories" in data:
-            if "benched_categories" not in data:
-                data["benched_categories"] = []
-                save_todos(data)
-            print("To-do list is already in the new format.")
-        else:
-            print("Unknown format, please check the data manually.")
-    else:
+# New file contents are staged as e.g. todo_list.json.pending-42 until change 42 commits
+PENDING_SUFFIX = '.pending-'
+
+def migrate_todo_data(data):
+    # Brings a parsed to-do document (None when there is no file yet) into the
+    # current format in memory. The migrated form is written out by the next
+    # change committed through commit_store.
+    if data is None:
         # No existing file, create a new structure
-        save_todos({
-            "subcategories": {"default": []},
-            "benched_categories": []
-        })
         print("Initialized new to-do list structure.")
+        return {"subcategories": {"default": []}, "benched_categories": []}
+    if isinstance(data, list):
+        # Old format detected, migrate to new format
+        print("Migrated old to-do list format to new subcategory format.")
+        return {"subcategories": {"default": data}, "benched_categories": []}
+    if isinstance(data, dict) and "subcategories" in data:
+        data.setdefault("benched_categories", [])
+        print("To-do list is already in the new format.")
+    else:
+        print("Unknown format, please check the data manually.")
+    return data
 
 def initialize_task_fields(todos):
     for subcategory in todos["subcategories"]:
@@ -47,13 +47,11 @@ def initialize_task_fields(todos):
     return todos
 
 def load_todos():
-    migrate_todo_data()  # Ensure data is migrated before loading
+    data = None
     if os.path.exists(TODO_FILE):
         with open(TODO_FILE, 'r') as file:
-            todos = json.load(file)
-        todos = initialize_task_fields(todos)
-        return todos
-    return initialize_task_fields({"subcategories": {"default": []}, "benched_categories": []})
+            data = json.load(file)
+    return initialize_task_fields(migrate_todo_data(data))
 
 def load_ideas():
     if os.path.exists(IDEAS_FILE):
@@ -61,13 +59,248 @@ def load_ideas():
             return json.load(file)
     return []
 
-def save_todos(todos):
-    with open(TODO_FILE, 'w') as file:
-        json.dump(todos, file, indent=4)
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def file_stamps():
+    return (_stamp(TODO_FILE), _stamp(IDEAS_FILE))
+
+def _write_pending(path, data, seq):
+    pending = f"{path}{PENDING_SUFFIX}{seq}"
+    with open(pending, 'w') as file:
+        json.dump(data, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    return pending
+
+def recover_pending(journal):
+    # Finishes a commit interrupted after its journal entry was written, or
+    # throws away one interrupted before that, so both files always match
+    # the journal. Must be called with the journal lock held.
+    committed = last_seq(journal)
+    for path in (TODO_FILE, IDEAS_FILE):
+        for pending in glob.glob(glob.escape(path) + PENDING_SUFFIX + '*'):
+            if int(pending.rsplit('-', 1)[1]) == committed:
+                os.replace(pending, path)
+            else:
+                os.remove(pending)
+
+@contextmanager
+def locked_store():
+    with locked_journal() as journal:
+        drop_torn_entry(journal)
+        recover_pending(journal)
+        yield journal
+
+def commit_store(journal, ops, source, todos=None, ideas=None, **marks):
+    # Applies ops to the loaded documents and commits them as one change:
+    # the new files are staged, the journal entry is the commit point, and
+    # only then are the staged files renamed over the originals. Nothing is
+    # written if any op fails to apply.
+    undo = apply_ops(todos, ideas, ops)
+    seq = last_seq(journal) + 1
+    staged = []
+    if todos is not None and any(op["op"] in TODO_OPS for op in ops):
+        staged.append((_write_pending(TODO_FILE, todos, seq), TODO_FILE))
+    if ideas is not None and any(op["op"] in IDEA_OPS for op in ops):
+        staged.append((_write_pending(IDEAS_FILE, ideas, seq), IDEAS_FILE))
+    # Each file's stamp before and after, so readers can tell these writes
+    # from edits made outside the journal (the renames keep mtime and size)
+    stamps = {path: [_stamp(path), _stamp(pending)] for pending, path in staged}
+    entry = append_change(journal, ops, source, undo, stamps=stamps, **marks)
+    for pending, path in staged:
+        os.replace(pending, path)
+    return entry
+
+@contextmanager
+def edit_store(source='repl', todos=True, ideas=True):
+    # Loads the requested documents (each parsed once) under the journal lock
+    # and yields them with an empty list of change operations. Whatever ops
+    # the caller appends are committed atomically as one change-feed entry.
+    with locked_store() as journal:
+        todos_doc = load_todos() if todos else None
+        ideas_doc = load_ideas() if ideas else None
+        ops = []
+        yield todos_doc, ideas_doc, ops
+        if ops:
+            commit_store(journal, ops, source, todos_doc, ideas_doc)
+
+@contextmanager
+def edit_todos(source='repl'):
+    with edit_store(source, ideas=False) as (todos, _, ops):
+        yield todos, ops
+
+@contextmanager
+def edit_ideas(source='repl'):
+    with edit_store(source, todos=False) as (_, ideas, ops):
+        yield ideas, ops
+
+def describe_change(entry):
+    kinds = ", ".join(sorted({op["op"].replace('_', ' ') for op in entry["ops"]}))
+    return f"change {entry['seq']} ({kinds}, by {entry['source']} at {entry['time']})"
 
-def save_ideas(ideas):
-    with open(IDEAS_FILE, 'w') as file:
-        json.dump(ideas, file, indent=4)
+def _reverse_change(find_target, mark, source, seq):
+    # Applies the inverse of change `seq`, provided find_target still picks
+    # it, and records it as a new entry so other processes pick the undo/redo
+    # up like any change
+    with locked_store() as journal:
+        target = find_target()
+        if target is None or target["seq"] != seq:
+            raise ValueError("The change history moved on in the meantime; nothing was changed.")
+        if "undo" not in target:
+            raise ValueError(f"Cannot reverse {describe_change(target)}: it has no undo information.")
+        ops = target["undo"]
+        todos = load_todos() if any(op["op"] in TODO_OPS for op in ops) else None
+        ideas = load_ideas() if any(op["op"] in IDEA_OPS for op in ops) else None
+        try:
+            commit_store(journal, ops, source, todos, ideas, **{mark: target["seq"]})
+        except (IndexError, KeyError, ValueError) as e:
+            raise ValueError(f"Cannot reverse {describe_change(target)}: the data no longer matches ({e}).")
+        return target
+
+def _confirm_reverse(action, description, target, source):
+    # Changes made elsewhere (e.g. by the Discord bot) are only reversed on request
+    if target["source"] == source:
+        return True
+    answer = input(f"{action} {description}? It was made by {target['source']}, not {source}. (y/n): ")
+    return answer.strip().lower() == 'y'
+
+def undo_last_change(source='repl'):
+    target = find_undo_target()
+    if target is None:
+        print("Nothing to undo.")
+        return
+    if not _confirm_reverse("Undo", describe_change(target), target, source):
+        print("Undo cancelled.")
+        return
+    try:
+        _reverse_change(find_undo_target, "undo_of", source, target["seq"])
+    except ValueError as e:
+        print(e)
+        return
+    print(f"Undid {describe_change(target)}.")
+
+def redo_last_change(source='repl'):
+    target = find_redo_target()
+    if target is None:
+        print("Nothing to redo.")
+        return
+    # Describe the change being restored rather than the undo entry itself
+    description = describe_change(dict(target, seq=target['undo_of'], ops=target['undo']))
+    if not _confirm_reverse("Redo", description, target, source):
+        print("Redo cancelled.")
+        return
+    try:
+        _reverse_change(find_redo_target, "redo_of", source, target["seq"])
+    except ValueError as e:
+        print(e)
+        return
+    print(f"Redid {description}.")
+
+def parse_as_of(text):
+    # Accepts 2024-10-05 (end of that day) or a full ISO timestamp
+    moment = datetime.datetime.fromisoformat(text)
+    if 'T' not in text and ' ' not in text:
+        moment = moment.replace(hour=23, minute=59, second=59, microsecond=999999)
+    return moment.isoformat()
+
+def display_as_of(state, until, subcategory=None):
+    try:
+        todos, _ = rewind(state["todos"], state["ideas"], until)
+    except ValueError as e:
+        print(e)
+        return
+    history_start = first_change_time()
+    print(f"\nAs of {until}:")
+    if history_start is None or until < history_start:
+        print(f"(Change history {'starts at ' + history_start if history_start else 'is empty'}; earlier edits are not recorded, so this shows the oldest known state.)")
+    if subcategory is None:
+        display_subcategories(todos)
+    elif subcategory in todos["subcategories"]:
+        display_todos(todos, subcategory)
+    else:
+        print(f"Subcategory '{subcategory}' did not exist yet.\n")
+
+def new_state():
+    # "similar" is the near-duplicate index, built on first use; "stamps" are
+    # the (mtime, size) of both files as of the last sync
+    return {"todos": None, "ideas": None, "cursor": None, "similar": None, "stamps": None}
+
+def sync_state(state, on_op=None):
+    # Brings cached copies of both documents up to date from the change feed,
+    # calling on_op(entry, op) after each op is applied. Returns the entries
+    # applied, or None when everything had to be reloaded instead. Files
+    # edited by hand (without a journal entry) are noticed by their stamps
+    # no longer matching the ones recorded by the last entry that wrote them.
+    if state["cursor"] is not None:
+        # Under the lock so the files on disk match the entries just read
+        with shared_journal():
+            entries = read_changes(state["cursor"])
+            stamps = file_stamps()
+        expected = list(state["stamps"])
+        for entry in entries or []:
+            for position, path in enumerate((TODO_FILE, IDEAS_FILE)):
+                if "stamps" not in entry:
+                    expected[position] = stamps[position]  # Older entry; trust the files
+                elif path in entry["stamps"]:
+                    before, after = (tuple(stamp) if stamp else None for stamp in entry["stamps"][path])
+                    # A mismatch before the write means the file was edited by hand first
+                    expected[position] = after if before == expected[position] else False
+        if entries is not None and tuple(expected) == stamps:
+            try:
+                for entry in entries:
+                    for op in entry["ops"]:
+                        apply_ops(state["todos"], state["ideas"], [op])
+                        if state["similar"] is not None and not index_change(state["similar"], state["todos"], state["ideas"], op):
+                            state["similar"] = None
+                        if on_op:
+                            on_op(entry, op)
+                state["stamps"] = stamps
+                return entries
+            except (IndexError, KeyError, ValueError):
+                pass  # Cached copy no longer matches the feed; reload below
+    with locked_store() as journal:
+        state["todos"] = load_todos()
+        state["ideas"] = load_ideas()
+        state["cursor"] = cursor_at_end(journal)
+        state["stamps"] = file_stamps()
+    state["similar"] = None
+    return None
+
+def state_version(state):
+    # Identifies the data held in state: the journal position it was synced
+    # to, and the file stamps (which tell reloads after hand edits apart)
+    return (state["cursor"]["seq"], state["stamps"])
+
+def find_duplicates(state, text):
+    # Returns (similarity, text, where) for existing tasks and ideas like text
+    if state["similar"] is None:
+        state["similar"] = build_similarity_index(state["todos"], state["ideas"])
+    items = state["similar"]["items"]
+    return [(score, items[key]["text"], items[key]["label"]) for score, key in find_similar(state["similar"], text)]
+
+def warn_if_duplicate(state, text):
+    for score, existing, where in find_duplicates(state, text):
+        print(f"Possible duplicate ({score:.0%} similar) in {where}: {existing}")
+
+def display_duplicates(state):
+    if state["similar"] is None:
+        state["similar"] = build_similarity_index(state["todos"], state["ideas"])
+    items = state["similar"]["items"]
+    # Completed tasks are done with, so only open tasks and ideas are compared
+    open_keys = {todo_key(task) for tasks in state["todos"]["subcategories"].values() for task in tasks if not task.get('completed')}
+    open_keys.update(idea_key(idea) for idea in state["ideas"])
+    pairs = find_pairs(state["similar"], keys=open_keys)
+    print(f"\nLikely duplicates ({len(pairs)} pairs):")
+    for idx, (score, key, other) in enumerate(pairs):
+        print(f"{idx + 1}. ({score:.0%} similar)")
+        for item_key in (key, other):
+            print(f"   - {items[item_key]['text']} (In: {items[item_key]['label']}, Created: {item_key[1]})")
+    print()
 
 def display_subcategories(todos):
     print("\nSubcategories:")
@@ -115,15 +348,25 @@ def display_todos(todos, subcategory, show_benched=False):
     print()
     return displayed_todos
 
+def display_query_results(state, subcategory, query):
+    tasks = state["todos"]["subcategories"][subcategory]
+    index = cached_index(TODO_FILE, subcategory, tasks, state_version(state))
+    total, window = run_query(index, query)
+    first = query["offset"] + 1 if window else 0
+    print(f"\nQuery results ({subcategory}): showing {first}-{query['offset'] + len(window)} of {total}")
+    for count, idx in enumerate(window, start=1):
+        print(f"{count}. {format_task(tasks[idx])}")
+    print()
+    return window
+
 def display_ideas(ideas):
     print("\nIdeas:")
     for idx, idea in enumerate(ideas):
         print(f"{idx + 1}. {idea['task']} (Created: {idea['created']})")
     print()
 
-def add_todo(task, subcategory):
-    todos = load_todos()
-    new_todo = {
+def new_task(task):
+    return {
         "task": task,
         "created": datetime.datetime.now().isoformat(),
         "completed": None,
@@ -133,141 +376,164 @@ def add_todo(task, subcategory):
         "start_time": None,
         "time_spent": 0  # In seconds
     }
-    todos["subcategories"][subcategory].append(new_todo)
-    save_todos(todos)
+
+def add_todo(task, subcategory, extra_fields=None, source='repl'):
+    new_todo = new_task(task)
+    if extra_fields:
+        new_todo.update(extra_fields)
+    with edit_todos(source) as (todos, ops):
+        ops.append({"op": "add", "subcategory": subcategory, "task": new_todo})
+    return new_todo
 
 def add_idea(task):
-    ideas = load_ideas()
     new_idea = {
         "task": task,
         "created": datetime.datetime.now().isoformat()
     }
-    ideas.append(new_idea)
-    save_ideas(ideas)
+    with edit_ideas() as (ideas, ops):
+        ops.append({"op": "add_idea", "idea": new_idea})
+
+def parse_index_list(text):
+    # Turns "1,4,7" or "2-5" (or a mix like "1,3-5") into sorted 0-based indexes
+    indexes = set()
+    for part in text.replace(' ', '').split(','):
+        first, sep, last = part.partition('-')
+        start = int(first)
+        end = int(last) if sep else start
+        if start < 1 or end < start:
+            raise ValueError(f"Invalid range '{part}'.")
+        indexes.update(range(start - 1, end))
+    return sorted(indexes)
+
+def promote_ideas(indexes, subcategory):
+    # Moves several ideas into a to-do subcategory as one atomic change
+    with edit_store() as (todos, ideas, ops):
+        if subcategory not in todos["subcategories"]:
+            print(f"Subcategory '{subcategory}' does not exist.")
+            return False
+        if not indexes or not all(0 <= index < len(ideas) for index in indexes):
+            print("Invalid index.")
+            return False
+        for index in indexes:
+            ops.append({"op": "add", "subcategory": subcategory, "task": new_task(ideas[index]['task'])})
+        # Remove from the back so earlier positions stay valid
+        for index in reversed(indexes):
+            ops.append({"op": "remove_idea", "index": index, "created": ideas[index].get('created')})
+    return True
+
+def drop_ideas(indexes):
+    with edit_ideas() as (ideas, ops):
+        if not indexes or not all(0 <= index < len(ideas) for index in indexes):
+            print("Invalid index.")
+            return False
+        for index in reversed(indexes):
+            ops.append({"op": "remove_idea", "index": index, "created": ideas[index].get('created')})
+    return True
 
 def move_idea_to_todo(index, subcategory):
-    ideas = load_ideas()
-    if 0 <= index < len(ideas):
-        idea = ideas.pop(index)
-        add_todo(idea['task'], subcategory)
-        save_ideas(ideas)
+    if promote_ideas([index], subcategory):
         print(f"Moved idea {index + 1} to to-do list under {subcategory}.")
-    else:
-        print("Invalid index.")
+
+def stop_fields(task):
+    # Fields that take a task out of progress and bank the time spent on it
+    time_spent = (datetime.datetime.now() - datetime.datetime.fromisoformat(task['start_time'])).total_seconds()
+    return {"in_progress": False, "time_spent": task.get('time_spent', 0) + time_spent, "start_time": None}
 
 def mark_todo_complete(index, displayed_todos, subcategory):
-    todos = load_todos()
-    if 0 <= index < len(displayed_todos):
-        todo_index = displayed_todos[index]
-        todos["subcategories"][subcategory][todo_index]['completed'] = datetime.datetime.now().isoformat()
-        if todos["subcategories"][subcategory][todo_index]['in_progress']:
-            todos["subcategories"][subcategory][todo_index]['in_progress'] = False
-            time_spent = (datetime.datetime.now() - datetime.datetime.fromisoformat(todos["subcategories"][subcategory][todo_index]['start_time'])).total_seconds()
-            todos["subcategories"][subcategory][todo_index]['time_spent'] += time_spent
-            todos["subcategories"][subcategory][todo_index]['start_time'] = None
-        save_todos(todos)
-        print(f"Marked item {index + 1} as complete.")
-    else:
-        print("Invalid index.")
+    with edit_todos() as (todos, ops):
+        if 0 <= index < len(displayed_todos):
+            todo_index = displayed_todos[index]
+            task = todos["subcategories"][subcategory][todo_index]
+            fields = {"completed": datetime.datetime.now().isoformat()}
+            if task['in_progress']:
+                fields.update(stop_fields(task))
+            ops.append({"op": "update", "subcategory": subcategory, "index": todo_index, "fields": fields})
+            print(f"Marked item {index + 1} as complete.")
+        else:
+            print("Invalid index.")
 
 def bench_todo_item(index, displayed_todos, subcategory):
-    todos = load_todos()
-    if 0 <= index < len(displayed_todos):
-        todo_index = displayed_todos[index]
-        todos["subcategories"][subcategory][todo_index]['benched'] = datetime.datetime.now().isoformat()
-        save_todos(todos)
-        print(f"Benched item {index + 1}.")
-    else:
-        print("Invalid index.")
+    with edit_todos() as (todos, ops):
+        if 0 <= index < len(displayed_todos):
+            todo_index = displayed_todos[index]
+            fields = {"benched": datetime.datetime.now().isoformat()}
+            ops.append({"op": "update", "subcategory": subcategory, "index": todo_index, "fields": fields})
+            print(f"Benched item {index + 1}.")
+        else:
+            print("Invalid index.")
 
 def bench_category(subcategory):
-    todos = load_todos()
-    if subcategory in todos["subcategories"]:
-        if subcategory not in todos.get("benched_categories", []):
-            if "benched_categories" not in todos:
-                todos["benched_categories"] = []
-            todos["benched_categories"].append(subcategory)
-            save_todos(todos)
-            print(f"Benched category '{subcategory}'.")
+    with edit_todos() as (todos, ops):
+        if subcategory in todos["subcategories"]:
+            if subcategory not in todos.get("benched_categories", []):
+                ops.append({"op": "bench_category", "subcategory": subcategory})
+                print(f"Benched category '{subcategory}'.")
+            else:
+                print(f"Category '{subcategory}' is already benched.")
         else:
-            print(f"Category '{subcategory}' is already benched.")
-    else:
-        print(f"Category '{subcategory}' does not exist.")
+            print(f"Category '{subcategory}' does not exist.")
 
 def unbench_category(subcategory):
-    todos = load_todos()
-    if subcategory in todos.get("benched_categories", []):
-        todos["benched_categories"].remove(subcategory)
-        save_todos(todos)
-        print(f"Unbenched category '{subcategory}'.")
-    else:
-        print(f"Category '{subcategory}' is not benched.")
+    with edit_todos() as (todos, ops):
+        if subcategory in todos.get("benched_categories", []):
+            ops.append({"op": "unbench_category", "subcategory": subcategory})
+            print(f"Unbenched category '{subcategory}'.")
+        else:
+            print(f"Category '{subcategory}' is not benched.")
 
 def unbench_todo_item(index, displayed_todos, subcategory):
-    todos = load_todos()
-    if 0 <= index < len(displayed_todos):
-        todo_index = displayed_todos[index]
-        todos["subcategories"][subcategory][todo_index]['unbenched'] = datetime.datetime.now().isoformat()
-        todos["subcategories"][subcategory][todo_index]['benched'] = None
-        save_todos(todos)
-        print(f"Unbenched item {index + 1}.")
-    else:
-        print("Invalid index.")
+    with edit_todos() as (todos, ops):
+        if 0 <= index < len(displayed_todos):
+            todo_index = displayed_todos[index]
+            fields = {"unbenched": datetime.datetime.now().isoformat(), "benched": None}
+            ops.append({"op": "update", "subcategory": subcategory, "index": todo_index, "fields": fields})
+            print(f"Unbenched item {index + 1}.")
+        else:
+            print("Invalid index.")
 
 def create_subcategory(subcategory):
-    todos = load_todos()
-    if subcategory not in todos["subcategories"]:
-        todos["subcategories"][subcategory] = []
-        save_todos(todos)
-        print(f"Created subcategory '{subcategory}'.")
-    else:
-        print(f"Subcategory '{subcategory}' already exists.")
+    with edit_todos() as (todos, ops):
+        if subcategory not in todos["subcategories"]:
+            ops.append({"op": "create_subcategory", "subcategory": subcategory})
+            print(f"Created subcategory '{subcategory}'.")
+        else:
+            print(f"Subcategory '{subcategory}' already exists.")
 
 def move_todo_to_subcategory(index, displayed_todos, from_subcategory, to_subcategory):
-    todos = load_todos()
-    if 0 <= index < len(displayed_todos):
-        todo_index = displayed_todos[index]
-        todo_item = todos["subcategories"][from_subcategory].pop(todo_index)
-        todos["subcategories"][to_subcategory].append(todo_item)
-        save_todos(todos)
-        print(f"Moved item {index + 1} from '{from_subcategory}' to '{to_subcategory}'.")
-    else:
-        print("Invalid index.")
+    with edit_todos() as (todos, ops):
+        if to_subcategory not in todos["subcategories"]:
+            print(f"Subcategory '{to_subcategory}' does not exist.")
+        elif 0 <= index < len(displayed_todos):
+            todo_index = displayed_todos[index]
+            ops.append({"op": "move", "from": from_subcategory, "index": todo_index, "to": to_subcategory})
+            print(f"Moved item {index + 1} from '{from_subcategory}' to '{to_subcategory}'.")
+        else:
+            print("Invalid index.")
 
 def start_todo_in_progress(index, displayed_todos, subcategory):
-    todos = load_todos()
-    # Ensure no other item is in progress
-    for subcat, tasks in todos["subcategories"].items():
-        for task in tasks:
-            if task['in_progress']:
-                print("Another task is already in progress. Complete or stop that task before starting a new one.")
-                return
-    if 0 <= index < len(displayed_todos):
-        todo_index = displayed_todos[index]
-        todos["subcategories"][subcategory][todo_index]['in_progress'] = True
-        todos["subcategories"][subcategory][todo_index]['start_time'] = datetime.datetime.now().isoformat()
-        save_todos(todos)
-        print(f"Started item {index + 1} as in progress.")
-    else:
-        print("Invalid index.")
+    with edit_todos() as (todos, ops):
+        # Ensure no other item is in progress
+        for subcat, tasks in todos["subcategories"].items():
+            for task in tasks:
+                if task['in_progress']:
+                    print("Another task is already in progress. Complete or stop that task before starting a new one.")
+                    return
+        if 0 <= index < len(displayed_todos):
+            todo_index = displayed_todos[index]
+            fields = {"in_progress": True, "start_time": datetime.datetime.now().isoformat()}
+            ops.append({"op": "update", "subcategory": subcategory, "index": todo_index, "fields": fields})
+            print(f"Started item {index + 1} as in progress.")
+        else:
+            print("Invalid index.")
 
 def stop_todo_in_progress():
-    todos = load_todos()
-    found = False
-    for subcat, tasks in todos["subcategories"].items():
-        for task in tasks:
-            if task['in_progress']:
-                found = True
-                task['in_progress'] = False
-                time_spent = (datetime.datetime.now() - datetime.datetime.fromisoformat(task['start_time'])).total_seconds()
-                task['time_spent'] += time_spent
-                task['start_time'] = None
-                save_todos(todos)
-                print(f"Stopped task '{task['task']}' in progress.")
-                break
-        if found:
-            break
-    if not found:
+    with edit_todos() as (todos, ops):
+        for subcat, tasks in todos["subcategories"].items():
+            for todo_index, task in enumerate(tasks):
+                if task['in_progress']:
+                    ops.append({"op": "update", "subcategory": subcat, "index": todo_index, "fields": stop_fields(task)})
+                    print(f"Stopped task '{task['task']}' in progress.")
+                    return
         print("No task is currently in progress.")
 
 def display_recently_completed(todos, subcategory, number_of_tasks):
@@ -287,27 +553,53 @@ def main():
     show_benched = False
     in_ideas = False
     current_subcategory = None
+    current_query = None
+    state = new_state()
+    last_view = None
     
     while True:
+        # Only redraw when the data changed (here or in another process) or the view did
+        changed = sync_state(state) != []
+        view = (current_subcategory, in_ideas, show_benched, current_query)
+        redraw = changed or view != last_view
+        last_view = view
+        todos = state["todos"]
+        
         if current_subcategory is None:
-            todos = load_todos()
-            subcategories = display_subcategories(todos)
-            user_input = input("Enter the number of a subcategory to view its to-do list, 'create' followed by subcategory name to create a new subcategory, 'bench' followed by category name to bench a category, 'unbench' followed by category name to unbench a category, 'r NUMBER' followed by subcategory to view recently completed items, or 'q' to quit: ")
+            if redraw:
+                subcategories = display_subcategories(todos)
+            user_input = input("Enter the number of a subcategory to view its to-do list, 'create' followed by subcategory name to create a new subcategory, 'bench' followed by category name to bench a category, 'unbench' followed by category name to unbench a category, 'r NUMBER' followed by subcategory to view recently completed items, 'undo' or 'redo' to undo or redo the last change, 'asof' followed by a date to view the lists as of that date, 'dedupe' to list likely duplicate items, or 'q' to quit: ")
         else:
             if in_ideas:
-                ideas = load_ideas()
-                display_ideas(ideas)
-                user_input = input("Ideas view - Enter the number of an idea to move it to the to-do list, or 'i' to return to main list (or 'q' to quit): ")
+                if redraw:
+                    display_ideas(state["ideas"])
+                user_input = input("Ideas view - Enter the number of an idea to move it to the to-do list, 'promote' followed by numbers and optionally 'to' a subcategory to move several (e.g., 'promote 1,4,7 to ipe'), 'drop' followed by numbers to delete ideas (e.g., 'drop 2-5'), or 'i' to return to main list (or 'q' to quit): ")
             else:
-                todos = load_todos()
-                displayed_todos = display_todos(todos, current_subcategory, show_benched)
-                if show_benched:
+                if redraw and current_query is not None and not show_benched:
+                    displayed_todos = display_query_results(state, current_subcategory, current_query)
+                elif redraw:
+                    displayed_todos = display_todos(todos, current_subcategory, show_benched)
+                if current_query is not None and not show_benched:
+                    user_input = input("Query view - Enter the number of an item to mark it as complete, 'ls' followed by a query to refine (e.g., 'ls status:completed sort:-completed limit:10'), or 'ls' to return to the full list (or 'q' to quit): ")
+                elif show_benched:
                     user_input = input("Benched view - Enter the number of an item to unbench it, or 'v' to view main list (or 'q' to quit): ")
                 else:
-                    user_input = input(f"Enter a new to-do item, the number of an item to mark it as complete, 'b ' followed by the number of an item to bench it, 'i' to view ideas, 'v' to view benched items, 'move' or 'm ' followed by the number and subcategory to move an item (e.g., 'move 3 ia' or 'm 3 ia'), 'start' followed by the number to start an item in progress, 'stop' to stop the current in progress item, or 'back' to go back to subcategories (or 'q' to quit): ")
+                    user_input = input(f"Enter a new to-do item, the number of an item to mark it as complete, 'b ' followed by the number of an item to bench it, 'i' to view ideas, 'v' to view benched items, 'move' or 'm ' followed by the number and subcategory to move an item (e.g., 'move 3 ia' or 'm 3 ia'), 'start' followed by the number to start an item in progress, 'stop' to stop the current in progress item, 'ls' followed by a query to filter the list (e.g., 'ls status:active sort:-created limit:10'), 'undo' or 'redo' to undo or redo the last change, 'asof' followed by a date to view this list as of that date, or 'back' to go back to subcategories (or 'q' to quit): ")
 
         if user_input.lower() == 'q':
             break
+        elif user_input.lower() == 'undo':
+            undo_last_change()
+        elif user_input.lower() == 'redo':
+            redo_last_change()
+        elif user_input.lower() == 'dedupe':
+            display_duplicates(state)
+        elif user_input.lower().startswith('asof '):
+            try:
+                until = parse_as_of(user_input[5:].strip())
+                display_as_of(state, until, current_subcategory)
+            except ValueError:
+                print("Invalid date for viewing the list as of a date (e.g., 'asof 2024-10-01').")
         elif user_input.lower().startswith('bench ') and current_subcategory is None:
             _, category = user_input.split(' ', 1)
             bench_category(category)
@@ -316,6 +608,32 @@ def main():
             unbench_category(category)
         elif user_input.lower() == 'back' and current_subcategory is not None:
             current_subcategory = None
+            current_query = None
+        elif (user_input.lower() == 'ls' or user_input.lower().startswith('ls ')) and current_subcategory is not None and not in_ideas:
+            try:
+                query_text = user_input[3:].strip()
+                current_query = parse_query(query_text) if query_text else None
+                show_benched = False
+            except ValueError as e:
+                print(f"Invalid query: {e}")
+        elif user_input.lower().startswith('promote ') and in_ideas:
+            try:
+                selection, _, to_subcategory = user_input[8:].partition(' to ')
+                indexes = parse_index_list(selection)
+                to_subcategory = to_subcategory.strip() or current_subcategory
+                if to_subcategory is None:
+                    print("Specify the subcategory to move the ideas to (e.g., 'promote 1,4,7 to ipe').")
+                elif promote_ideas(indexes, to_subcategory):
+                    print(f"Moved {len(indexes)} ideas to to-do list under {to_subcategory}.")
+            except ValueError:
+                print("Invalid input for promoting ideas.")
+        elif user_input.lower().startswith('drop ') and in_ideas:
+            try:
+                indexes = parse_index_list(user_input[5:])
+                if drop_ideas(indexes):
+                    print(f"Dropped {len(indexes)} ideas.")
+            except ValueError:
+                print("Invalid input for dropping ideas.")
         elif user_input.lower() == 'v' and not in_ideas:
             show_benched = not show_benched
         elif user_input.lower() == 'i':
@@ -363,7 +681,6 @@ def main():
                 _, number_and_subcategory = user_input.split(' ', 1)
                 number_of_tasks, subcategory = number_and_subcategory.split(' ', 1)
                 number_of_tasks = int(number_of_tasks)
-                todos = load_todos()
                 display_recently_completed(todos, subcategory, number_of_tasks)
             except ValueError:
                 print("Invalid input for viewing recently completed items.")
@@ -371,11 +688,11 @@ def main():
             _, subcategory = user_input.split(' ', 1)
             create_subcategory(subcategory)
         elif not in_ideas:
+            warn_if_duplicate(state, user_input)
             add_todo(user_input, current_subcategory)
-            displayed_todos = display_todos(load_todos(), current_subcategory, show_benched)
         else:
+            warn_if_duplicate(state, user_input)
             add_idea(user_input)
-            display_ideas(load_ideas())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
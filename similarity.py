@@ -0,0 +1,149 @@
+import re
+import zlib
+import random
+
+# Near-duplicate detection for task and idea texts. Each text is reduced to
+# its character shingles and a MinHash signature; the signature is split into
+# bands and every band is hashed into a bucket (locality-sensitive hashing),
+# so texts that share a bucket are likely to be similar. Candidates from the
+# buckets are then checked with the exact Jaccard similarity of their shingles.
+
+SHINGLE_SIZE = 3
+NUM_BANDS = 16
+ROWS_PER_BAND = 2
+NUM_HASHES = NUM_BANDS * ROWS_PER_BAND
+# Character shingles of short texts overlap a lot (e.g. "finalize design air"
+# and "finalize design zero" score 0.67), so only near-identical texts count
+SIMILARITY_THRESHOLD = 0.75
+
+_MERSENNE_PRIME = (1 << 61) - 1
+# Fixed seed so signatures are the same in every process
+_rng = random.Random(1234)
+_HASH_PARAMS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_HASHES)]
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', text.lower()).strip()
+
+def shingles(text):
+    text = normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+def signature(shingle_set):
+    hashes = [zlib.crc32(shingle.encode()) for shingle in shingle_set]
+    return tuple(min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _HASH_PARAMS)
+
+def _bands(sig):
+    return [(band, sig[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]) for band in range(NUM_BANDS)]
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def new_similarity_index():
+    return {"items": {}, "buckets": {}}
+
+def add_text(index, key, text, label=None):
+    if key in index["items"]:
+        remove_text(index, key)
+    shingle_set = shingles(text)
+    if not shingle_set:
+        return
+    sig = signature(shingle_set)
+    index["items"][key] = {"text": text, "label": label, "shingles": shingle_set, "signature": sig}
+    for band in _bands(sig):
+        index["buckets"].setdefault(band, set()).add(key)
+
+def remove_text(index, key):
+    item = index["items"].pop(key, None)
+    if item is None:
+        return
+    for band in _bands(item["signature"]):
+        bucket = index["buckets"].get(band)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del index["buckets"][band]
+
+def relabel(index, key, label):
+    if key in index["items"]:
+        index["items"][key]["label"] = label
+
+def _candidates(index, sig):
+    found = set()
+    for band in _bands(sig):
+        found |= index["buckets"].get(band, set())
+    return found
+
+def find_similar(index, text, threshold=SIMILARITY_THRESHOLD, limit=5):
+    # Returns up to `limit` (similarity, key) pairs, most similar first
+    shingle_set = shingles(text)
+    if not shingle_set:
+        return []
+    matches = []
+    for key in _candidates(index, signature(shingle_set)):
+        score = jaccard(shingle_set, index["items"][key]["shingles"])
+        if score >= threshold:
+            matches.append((score, key))
+    matches.sort(reverse=True)
+    return matches[:limit]
+
+def find_pairs(index, threshold=SIMILARITY_THRESHOLD, keys=None):
+    # Returns every (similarity, key, other) pair of near-duplicates, most
+    # similar first, comparing each text only against the keys sharing one of
+    # its buckets. Pairs are not chained into groups, so two texts are only
+    # reported together when they are similar to each other. `keys` limits
+    # the search to those items.
+    items = index["items"]
+    pairs = []
+    for key in (items if keys is None else keys & items.keys()):
+        for other in _candidates(index, items[key]["signature"]):
+            if other <= key or (keys is not None and other not in keys):
+                continue
+            score = jaccard(items[key]["shingles"], items[other]["shingles"])
+            if score >= threshold:
+                pairs.append((score, key, other))
+    pairs.sort(reverse=True)
+    return pairs
+
+def todo_key(task):
+    return ("todo", task.get('created') or '')
+
+def idea_key(idea):
+    return ("idea", idea.get('created') or '')
+
+def build_similarity_index(todos, ideas):
+    index = new_similarity_index()
+    for subcategory, tasks in todos["subcategories"].items():
+        for task in tasks:
+            add_text(index, todo_key(task), task['task'], subcategory)
+    for idea in ideas or []:
+        add_text(index, idea_key(idea), idea['task'], "ideas")
+    return index
+
+def index_change(index, todos, ideas, op):
+    # Updates the index for one change-feed op already applied to the
+    # documents. Returns False when the caller should rebuild instead.
+    kind = op["op"]
+    if kind == "add":
+        add_text(index, todo_key(op["task"]), op["task"]['task'], op["subcategory"])
+    elif kind == "remove":
+        if "created" not in op:
+            return False
+        remove_text(index, ("todo", op["created"] or ''))
+    elif kind == "move":
+        tasks = todos["subcategories"][op["to"]]
+        task = tasks[-1] if op.get("to_index") is None else tasks[op["to_index"]]
+        relabel(index, todo_key(task), op["to"])
+    elif kind == "update" and 'task' in op["fields"]:
+        task = todos["subcategories"][op["subcategory"]][op["index"]]
+        add_text(index, todo_key(task), task['task'], op["subcategory"])
+    elif kind == "add_idea":
+        add_text(index, idea_key(op["idea"]), op["idea"]['task'], "ideas")
+    elif kind == "remove_idea":
+        if "created" not in op:
+            return False
+        remove_text(index, ("idea", op["created"] or ''))
+    return True
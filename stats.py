@@ -1,23 +1,16 @@
-import json
 import datetime
-import os
 import matplotlib.pyplot as plt
 from collections import defaultdict
 import sys
+from task_stream import iter_all_tasks, iter_subcategory_names
 
 # Path to the JSON file
 TODO_FILE = 'todo_list.json'
 
-def load_todos():
-    if os.path.exists(TODO_FILE):
-        with open(TODO_FILE, 'r') as file:
-            return json.load(file)
-    return {"subcategories": {"default": []}}
-
-def process_data(todos, subcategory):
+def process_data(tasks):
+    # Consumes an iterable of task dicts, e.g. from task_stream.iter_tasks
     time_spent_per_task = {}
     tasks_completed_over_time = defaultdict(int)
-    tasks = todos["subcategories"].get(subcategory, [])
     
     for task in tasks:
         if task.get("completed"):
@@ -51,18 +44,19 @@ def plot_tasks_completed(tasks_completed_over_time, subcategory):
     plt.show()
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <subcategory>")
+    if len(sys.argv) < 2:
+        print("Usage: python script.py <subcategory> [archive.jsonl ...]")
         sys.exit(1)
     
     subcategory = sys.argv[1]
-    todos = load_todos()
+    archive_paths = sys.argv[2:]
     
-    if subcategory not in todos["subcategories"]:
+    if subcategory not in iter_subcategory_names(TODO_FILE) and not archive_paths:
         print(f"Subcategory '{subcategory}' not found in the todo list.")
         sys.exit(1)
     
-    time_spent_per_task, tasks_completed_over_time = process_data(todos, subcategory)
+    tasks = (task for _, task in iter_all_tasks([TODO_FILE] + archive_paths, subcategory))
+    time_spent_per_task, tasks_completed_over_time = process_data(tasks)
     
     print(f"\nTime Spent per Task in {subcategory}:")
     for task, time_spent in time_spent_per_task.items():
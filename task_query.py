@@ -0,0 +1,205 @@
+from bisect import bisect_left, bisect_right
+
+# Query layer over a single subcategory's task list. Filters are answered
+# from secondary indexes built once per version of the list: status sets,
+# sorted (key, position) lists for dates and numbers, and per-user sets.
+#
+# Query syntax, whitespace separated, all terms ANDed together:
+#   status:active|in_progress|benched|completed   (comma separated for "any of")
+#   created>=2024-06-01  completed<2024-07-01     (also >, <=, <, =)
+#   added_by:alice  completed_by:bob              (user name or id)
+#   time>3600  time>=2h                           (time spent; s, m or h suffix)
+#   verified>=2                                   (verification count)
+#   sort:created  sort:-completed                 (created, completed, time, verified)
+#   limit:20  offset:40
+
+STATUSES = ("active", "in_progress", "benched", "completed")
+RANGE_FIELDS = {
+    "created": "created",
+    "completed": "completed",
+    "time": "time_spent",
+    "time_spent": "time_spent",
+    "verified": "verification_count",
+    "verifications": "verification_count",
+}
+USER_FIELDS = {
+    "added_by": ("added_by_id", "added_by_name"),
+    "completed_by": ("completed_by_id", "completed_by_name"),
+}
+DATE_FIELDS = ("created", "completed")
+OPERATORS = (">=", "<=", ">", "<", "=")
+DEFAULT_LIMIT = 20
+
+def task_status(task):
+    if task.get('completed'):
+        return "completed"
+    if task.get('benched'):
+        return "benched"
+    if task.get('in_progress'):
+        return "in_progress"
+    return "active"
+
+def build_index(tasks):
+    index = {
+        "size": len(tasks),
+        "status": {status: set() for status in STATUSES},
+        "sorted": {field: ([], []) for field in set(RANGE_FIELDS.values())},
+        "users": {field: {} for field in USER_FIELDS},
+    }
+    sorted_entries = {field: [] for field in index["sorted"]}
+    for idx, task in enumerate(tasks):
+        index["status"][task_status(task)].add(idx)
+        for field in DATE_FIELDS:
+            if task.get(field):
+                sorted_entries[field].append((task[field], idx))
+        sorted_entries["time_spent"].append((task.get("time_spent") or 0, idx))
+        sorted_entries["verification_count"].append((task.get("verification_count") or 0, idx))
+        for field, keys in USER_FIELDS.items():
+            for key in keys:
+                if task.get(key):
+                    index["users"][field].setdefault(str(task[key]).lower(), set()).add(idx)
+    for field, entries in sorted_entries.items():
+        entries.sort()
+        index["sorted"][field] = ([key for key, _ in entries], [idx for _, idx in entries])
+    return index
+
+_index_cache = {}
+
+def cached_index(path, subcategory, tasks, version):
+    # Reuses the index for a subcategory while the caller's copy of the data
+    # is at the same version, e.g. the change-feed position it synced to
+    cached = _index_cache.get((path, subcategory))
+    if cached and cached[0] == version:
+        return cached[1]
+    index = build_index(tasks)
+    _index_cache[(path, subcategory)] = (version, index)
+    return index
+
+def _parse_seconds(value):
+    multiplier = 1
+    if value[-1:].lower() in ("s", "m", "h"):
+        multiplier = {"s": 1, "m": 60, "h": 3600}[value[-1].lower()]
+        value = value[:-1]
+    return float(value) * multiplier
+
+def parse_query(text):
+    query = {
+        "status": None,
+        "ranges": [],
+        "users": [],
+        "sort": None,
+        "descending": False,
+        "limit": DEFAULT_LIMIT,
+        "offset": 0,
+    }
+    for term in text.split():
+        name, sep, value = term.partition(':')
+        if sep and (name in ("status", "sort", "limit", "offset") or name in USER_FIELDS):
+            if not value:
+                raise ValueError(f"Missing value in '{term}'.")
+            if name == "status":
+                statuses = set(value.lower().split(','))
+                unknown = statuses - set(STATUSES)
+                if unknown:
+                    raise ValueError(f"Unknown status '{', '.join(sorted(unknown))}'.")
+                query["status"] = statuses
+            elif name == "sort":
+                query["descending"] = value.startswith('-')
+                field = value.lstrip('-')
+                if field not in RANGE_FIELDS:
+                    raise ValueError(f"Cannot sort by '{field}'.")
+                query["sort"] = RANGE_FIELDS[field]
+            elif name in ("limit", "offset"):
+                query[name] = int(value)
+                if query[name] < 0:
+                    raise ValueError(f"'{name}' must not be negative.")
+            else:
+                query["users"].append((name, value.lower()))
+            continue
+        for op in OPERATORS:
+            name, sep, value = term.partition(op)
+            if sep:
+                break
+        if not sep or name not in RANGE_FIELDS or not value:
+            raise ValueError(f"Unrecognized query term '{term}'.")
+        field = RANGE_FIELDS[name]
+        if field in DATE_FIELDS:
+            bound = value
+        elif field == "time_spent":
+            bound = _parse_seconds(value)
+        else:
+            bound = int(value)
+        query["ranges"].append((field, op, bound))
+    return query
+
+def _range_positions(index, field, op, bound):
+    keys, positions = index["sorted"][field]
+    # A bare date like 2024-06-01 covers the whole day, so "up to and
+    # including" it means everything up to the end of that day
+    upper = bound + '~' if isinstance(bound, str) and 'T' not in bound else bound
+    if op == ">=":
+        lo, hi = bisect_left(keys, bound), len(keys)
+    elif op == ">":
+        lo, hi = bisect_right(keys, upper), len(keys)
+    elif op == "<=":
+        lo, hi = 0, bisect_right(keys, upper)
+    elif op == "<":
+        lo, hi = 0, bisect_left(keys, bound)
+    else:
+        lo, hi = bisect_left(keys, bound), bisect_right(keys, upper)
+    return set(positions[lo:hi])
+
+def run_query(index, query):
+    # Returns (number of matches, task positions in the requested window)
+    candidates = []
+    if query["status"] is not None:
+        candidates.append(set().union(*(index["status"][status] for status in query["status"])))
+    for field, op, bound in query["ranges"]:
+        candidates.append(_range_positions(index, field, op, bound))
+    for field, user in query["users"]:
+        candidates.append(index["users"][field].get(user, set()))
+
+    if candidates:
+        candidates.sort(key=len)
+        matches = candidates[0].intersection(*candidates[1:])
+        total = len(matches)
+    else:
+        matches = None
+        total = index["size"]
+
+    start, stop = query["offset"], query["offset"] + query["limit"]
+    if query["sort"] is None:
+        order = sorted(matches) if matches is not None else range(index["size"])
+    else:
+        _, positions = index["sorted"][query["sort"]]
+        order = reversed(positions) if query["descending"] else positions
+        if query["sort"] in DATE_FIELDS:
+            # Tasks without the date are not in its index; list them last
+            missing = sorted(set(range(index["size"])) - set(positions))
+            order = list(order) + missing
+
+    window = []
+    seen = 0
+    for idx in order:
+        if seen >= stop:
+            break
+        if matches is not None and idx not in matches:
+            continue
+        if seen >= start:
+            window.append(idx)
+        seen += 1
+    return total, window
+
+def format_task(todo):
+    status = task_status(todo).replace('_', ' ').title()
+    details = [f"Created: {todo.get('created', 'Unknown date')}", f"Status: {status}"]
+    if todo.get('completed'):
+        details.append(f"Completed: {todo['completed']}")
+    if todo.get('time_spent'):
+        details.append(f"Time spent: {todo['time_spent'] / 3600:.2f}h")
+    if todo.get('verification_count'):
+        details.append(f"Verifications: {todo['verification_count']}")
+    for key in ('added_by_name', 'completed_by_name'):
+        if todo.get(key):
+            details.append(f"{key.replace('_name', '').replace('_', ' ').capitalize()}: {todo[key]}")
+    return f"{todo['task']} ({', '.join(details)})"
@@ -0,0 +1,155 @@
+import json
+import mmap
+import os
+
+# Streaming, read-only access to tasks. Tasks are decoded one at a time from
+# the todo snapshot (either the subcategory format or the old flat list) or
+# from line-delimited archive segments, so memory use does not grow with the
+# size of the history being scanned.
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+class _ChunkReader:
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what has already been consumed so the buffer stays small
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos} of the todo file.")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A value that runs to the end of the buffer may be cut short
+                # (e.g. a number split across chunks), so read on to be sure
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def object_keys(self):
+        # Yields each key, leaving the reader positioned at its value; the
+        # caller must consume the value before asking for the next key
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+def _iter_snapshot(path, subcategory):
+    with open(path, 'r') as file:
+        reader = _ChunkReader(file)
+        if reader.peek() == '[':
+            # Old format: a flat list that migrates into "default"
+            if subcategory in (None, "default"):
+                for task in reader.array():
+                    yield "default", task
+            return
+        for key in reader.object_keys():
+            if key != "subcategories":
+                reader.value()
+                continue
+            for name in reader.object_keys():
+                for task in reader.array():
+                    if subcategory is None or name == subcategory:
+                        yield name, task
+
+def _iter_segment(path, subcategory):
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for line in iter(data.readline, b''):
+                line = line.strip()
+                if not line:
+                    continue
+                task = json.loads(line)
+                name = task.get("subcategory", "default")
+                if subcategory is None or name == subcategory:
+                    yield name, task
+
+def iter_tasks(path, subcategory=None):
+    # Yields (subcategory, task) pairs. Paths ending in .jsonl are read as
+    # archive segments: one task per line, tagged with its "subcategory".
+    if not os.path.exists(path):
+        return
+    if path.endswith('.jsonl'):
+        yield from _iter_segment(path, subcategory)
+    else:
+        yield from _iter_snapshot(path, subcategory)
+
+def iter_all_tasks(paths, subcategory=None):
+    for path in paths:
+        yield from iter_tasks(path, subcategory)
+
+def iter_subcategory_names(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as file:
+        reader = _ChunkReader(file)
+        if reader.peek() == '[':
+            yield "default"
+            return
+        for key in reader.object_keys():
+            if key != "subcategories":
+                reader.value()
+                continue
+            for name in reader.object_keys():
+                yield name
+                for _ in reader.array():
+                    pass
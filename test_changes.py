@@ -0,0 +1,66 @@
+import copy
+import pytest
+from changes import apply_ops
+
+def sample_documents():
+    todos = {
+        "subcategories": {
+            "default": [
+                {"task": "write report", "created": "2024-10-01T09:00:00", "completed": None, "in_progress": False},
+                {"task": "call bank", "created": "2024-10-02T09:00:00", "completed": None, "benched": "2024-10-03T09:00:00"},
+                {"task": "book flights", "created": "2024-10-04T09:00:00", "completed": "2024-10-05T09:00:00"},
+            ],
+            "ipe": [
+                {"task": "review slides", "created": "2024-10-06T09:00:00", "completed": None},
+            ],
+        },
+        "benched_categories": ["ipe"],
+    }
+    ideas = [
+        {"task": "learn rust", "created": "2024-09-01T09:00:00"},
+        {"task": "start a podcast", "created": "2024-09-02T09:00:00"},
+    ]
+    return todos, ideas
+
+def test_undo_ops_restore_original_documents():
+    todos, ideas = sample_documents()
+    original = copy.deepcopy((todos, ideas))
+    ops = [
+        {"op": "add", "subcategory": "default", "task": {"task": "new task", "created": "2024-10-07T09:00:00"}},
+        {"op": "update", "subcategory": "default", "index": 0, "fields": {"completed": "2024-10-08T09:00:00", "in_progress": True}, "unset": ["task"]},
+        {"op": "update", "subcategory": "default", "index": 1, "fields": {"unbenched": "2024-10-08T09:00:00", "benched": None}},
+        {"op": "move", "from": "default", "index": 2, "to": "ipe", "to_index": 0},
+        {"op": "remove", "subcategory": "ipe", "index": 1, "created": "2024-10-06T09:00:00"},
+        {"op": "create_subcategory", "subcategory": "errands"},
+        {"op": "unbench_category", "subcategory": "ipe"},
+        {"op": "bench_category", "subcategory": "default"},
+        {"op": "add_idea", "idea": {"task": "plant a garden", "created": "2024-10-09T09:00:00"}, "index": 0},
+        {"op": "remove_idea", "index": 2, "created": "2024-09-02T09:00:00"},
+        {"op": "add", "subcategory": "errands", "task": {"task": "buy milk", "created": "2024-10-10T09:00:00"}},
+        {"op": "remove", "subcategory": "errands", "index": 0},
+        {"op": "delete_subcategory", "subcategory": "errands"},
+    ]
+    undo = apply_ops(todos, ideas, copy.deepcopy(ops))
+    changed = copy.deepcopy((todos, ideas))
+    assert changed != original
+
+    redo = apply_ops(todos, ideas, undo)
+    assert (todos, ideas) == original
+
+    # The inverse of the inverse replays the original change
+    apply_ops(todos, ideas, redo)
+    assert (todos, ideas) == changed
+
+def test_inverse_ops_refuse_a_different_task():
+    todos, ideas = sample_documents()
+    undo = apply_ops(todos, ideas, [
+        {"op": "update", "subcategory": "default", "index": 0, "fields": {"completed": "2024-10-08T09:00:00"}},
+        {"op": "move", "from": "default", "index": 1, "to": "ipe"},
+    ])
+    # Someone else inserts a task at the front, shifting every position
+    todos["subcategories"]["default"].insert(0, {"task": "urgent", "created": "2024-10-11T09:00:00"})
+    todos["subcategories"]["ipe"].insert(0, {"task": "later", "created": "2024-10-12T09:00:00"})
+    with pytest.raises(ValueError):
+        apply_ops(todos, ideas, undo[:1])
+    with pytest.raises(ValueError):
+        apply_ops(todos, ideas, undo[1:])
@@ -0,0 +1,103 @@
+import os
+import glob
+import json
+import select
+import pytest
+
+pytest.importorskip("matplotlib")
+
+import idl
+from changes import CHANGES_FILE, last_seq, open_watch, drain_watch
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # The data files and the journal are relative paths, so run in a scratch directory
+    monkeypatch.chdir(tmp_path)
+    idl.add_todo("write report", "default")
+    idl.add_idea("learn rust")
+    return tmp_path
+
+def is_readable(fd):
+    return bool(select.select([fd], [], [], 0)[0])
+
+def test_sync_state_does_not_wake_watchers(store):
+    state = idl.new_state()
+    idl.sync_state(state)
+    fd = open_watch()
+    if fd is None:
+        pytest.skip("inotify is not available")
+    try:
+        drain_watch(fd)
+        assert idl.sync_state(state) == []
+        assert not is_readable(fd)
+
+        # A real change still wakes it
+        idl.add_todo("call bank", "default")
+        assert is_readable(fd)
+    finally:
+        os.close(fd)
+
+def read_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+def journal_seq():
+    with idl.locked_journal() as journal:
+        return last_seq(journal)
+
+def test_commit_interrupted_between_renames_is_completed(store, monkeypatch):
+    real_replace = os.replace
+    calls = []
+
+    def crash_on_second_rename(src, dst):
+        calls.append(dst)
+        if len(calls) == 2:
+            raise OSError("simulated crash")
+        real_replace(src, dst)
+
+    monkeypatch.setattr(idl.os, "replace", crash_on_second_rename)
+    with pytest.raises(OSError):
+        idl.promote_ideas([0], "default")
+    monkeypatch.setattr(idl.os, "replace", real_replace)
+
+    # Only one file was renamed, but the change was committed to the journal
+    seq = journal_seq()
+    assert glob.glob("*.pending-*") == [f"{calls[1]}.pending-{seq}"]
+
+    with idl.locked_store():
+        pass
+    assert glob.glob("*.pending-*") == []
+    assert [task["task"] for task in read_json(idl.TODO_FILE)["subcategories"]["default"]] == ["write report", "learn rust"]
+    assert read_json(idl.IDEAS_FILE) == []
+
+def test_torn_journal_entry_is_rolled_back(store, monkeypatch):
+    todos_before = read_json(idl.TODO_FILE)
+    ideas_before = read_json(idl.IDEAS_FILE)
+    seq = journal_seq()
+
+    def crash_mid_append(journal, ops, source, undo, **marks):
+        journal.write('{"seq": %d, "time": "20' % (seq + 1))
+        journal.flush()
+        raise OSError("simulated crash")
+
+    real_append = idl.append_change
+    monkeypatch.setattr(idl, "append_change", crash_mid_append)
+    with pytest.raises(OSError):
+        idl.promote_ideas([0], "default")
+    monkeypatch.setattr(idl, "append_change", real_append)
+    assert len(glob.glob("*.pending-*")) == 2
+
+    # Readers ignore the torn line; the next writer cuts it off
+    state = idl.new_state()
+    idl.sync_state(state)
+    assert state["cursor"]["seq"] == seq
+    with idl.locked_store():
+        pass
+    assert glob.glob("*.pending-*") == []
+    assert read_json(idl.TODO_FILE) == todos_before
+    assert read_json(idl.IDEAS_FILE) == ideas_before
+    with open(CHANGES_FILE) as journal:
+        assert journal.read().endswith('}\n')
+
+    idl.add_idea("start a podcast")
+    assert journal_seq() == seq + 1
@@ -0,0 +1,107 @@
+import heapq
+from bisect import bisect_left, insort
+
+# Per-user activity index. For every user id it keeps the tasks they added,
+# started, completed and verified as (timestamp, task key) lists sorted by
+# time, plus a set of the task keys they have verified. A task key is
+# (subcategory, created timestamp), which stays stable when tasks move
+# position within a list.
+
+ACTIVITY_KINDS = ("added", "started", "completed", "verified")
+
+def task_key(subcategory, task):
+    return (subcategory, task.get('created') or '')
+
+def new_user_index():
+    return {"users": {}, "titles": {}}
+
+def _user_entry(index, user_id, name):
+    entry = index["users"].get(user_id)
+    if entry is None:
+        entry = {kind: [] for kind in ACTIVITY_KINDS}
+        entry["name"] = name
+        entry["verified_keys"] = set()
+        index["users"][user_id] = entry
+    elif name:
+        entry["name"] = name
+    return entry
+
+def record_activity(index, user_id, name, kind, timestamp, key):
+    entry = _user_entry(index, str(user_id), name)
+    insort(entry[kind], (timestamp or '', key))
+    if kind == "verified":
+        entry["verified_keys"].add(key)
+
+def index_task(index, subcategory, task):
+    key = task_key(subcategory, task)
+    index["titles"][key] = task['task']
+    if task.get('added_by_id'):
+        record_activity(index, task['added_by_id'], task.get('added_by_name'), "added", task.get('created'), key)
+    if task.get('started_by_id'):
+        started = task.get('started_at') or task.get('start_time') or task.get('created')
+        record_activity(index, task['started_by_id'], task.get('started_by_name'), "started", started, key)
+    if task.get('completed_by_id') and task.get('completed'):
+        record_activity(index, task['completed_by_id'], task.get('completed_by_name'), "completed", task['completed'], key)
+    for verification in task.get('verifications', []):
+        record_activity(index, verification['id'], verification.get('name'), "verified", verification.get('verified_at'), key)
+
+def build_user_index(todos):
+    index = new_user_index()
+    for subcategory, tasks in todos["subcategories"].items():
+        for task in tasks:
+            index_task(index, subcategory, task)
+    return index
+
+def has_verified(index, user_id, key):
+    entry = index["users"].get(str(user_id))
+    return entry is not None and key in entry["verified_keys"]
+
+def _events_since(index, user_id, kind, since):
+    # Returns the user's sorted events and the position of the first one at
+    # or after `since`, found by bisection rather than by copying
+    entry = index["users"].get(str(user_id))
+    if entry is None:
+        return [], 0
+    events = entry[kind]
+    return events, 0 if since is None else bisect_left(events, (since,))
+
+def activity_since(index, user_id, kind, since=None, limit=None):
+    # The most recent `limit` events (all when None), oldest first
+    events, start = _events_since(index, user_id, kind, since)
+    if limit is not None:
+        start = max(start, len(events) - limit)
+    return events[start:]
+
+def count_since(index, user_id, kind, since=None):
+    events, start = _events_since(index, user_id, kind, since)
+    return len(events) - start
+
+def activity_counts(index, user_id, since=None):
+    return {kind: count_since(index, user_id, kind, since) for kind in ACTIVITY_KINDS}
+
+def leaderboard(index, kind="completed", since=None, top=10):
+    counts = ((count_since(index, user_id, kind, since), user_id) for user_id in index["users"])
+    return [(index["users"][user_id]["name"], count) for count, user_id in heapq.nlargest(top, counts) if count]
+
+def index_op(index, todos, op):
+    # Updates the index for one change-feed op already applied to todos.
+    # Returns False when the op cannot be applied incrementally (e.g. a move
+    # or removal changes task keys) and the caller should rebuild the index.
+    if op["op"] == "add":
+        index_task(index, op["subcategory"], todos["subcategories"][op["subcategory"]][-1])
+    elif op["op"] == "update":
+        task = todos["subcategories"][op["subcategory"]][op["index"]]
+        key = task_key(op["subcategory"], task)
+        fields = op["fields"]
+        if fields.get('started_by_id'):
+            record_activity(index, fields['started_by_id'], fields.get('started_by_name'), "started", fields.get('started_at') or fields.get('start_time'), key)
+        if fields.get('completed_by_id') and fields.get('completed'):
+            record_activity(index, fields['completed_by_id'], fields.get('completed_by_name'), "completed", fields['completed'], key)
+        for verification in fields.get('verifications', []):
+            if not has_verified(index, verification['id'], key):
+                record_activity(index, verification['id'], verification.get('name'), "verified", verification.get('verified_at'), key)
+        if 'task' in fields:
+            index["titles"][key] = fields['task']
+    elif op["op"] in ("move", "remove", "delete_subcategory"):
+        return False
+    return True